@@ -0,0 +1,294 @@
+import copy
+
+import pytest
+
+import torch
+import torch.nn as nn
+
+from hw2.cnn import CNN, ResidualBlock, ResNet, YourCNN
+
+IN_SIZE = (3, 8, 8)
+
+
+def make_cnn(**kwargs):
+    return CNN(
+        in_size=IN_SIZE, out_classes=4, channels=[4, 5], pool_every=10, hidden_dims=[6],
+        conv_params=dict(kernel_size=3, padding=1), **kwargs
+    )
+
+
+N_FEATURES_CASES = [
+    (CNN, dict(conv_params=dict(kernel_size=3, padding=1), pooling_params=dict(kernel_size=2))),
+    (CNN, dict(conv_params=dict(kernel_size=3, stride=2), pooling_params=dict(kernel_size=2), pool_every=4)),
+    (CNN, dict(conv_params=dict(kernel_size=3, dilation=2, padding=1),
+               pooling_params=dict(kernel_size=3, stride=2, padding=1))),
+    (CNN, dict(conv_params=dict(kernel_size=4, stride=3, padding=2),
+               pooling_params=dict(kernel_size=3, stride=2, ceil_mode=True), channels=[4, 5, 6], pool_every=3)),
+    (CNN, dict(conv_params=dict(kernel_size=3, padding="same"), pooling_type="avg",
+               pooling_params=dict(kernel_size=2, ceil_mode=True))),
+    (ResNet, dict(pooling_params=dict(kernel_size=2))),
+    (ResNet, dict(pooling_params=dict(kernel_size=3, stride=2, padding=1, ceil_mode=True))),
+    (YourCNN, dict()),
+    (YourCNN, dict(pooling_params=dict(kernel_size=3, stride=2, ceil_mode=True))),
+]
+
+
+class TestNFeatures(object):
+    @pytest.mark.parametrize("model_cls, kwargs", N_FEATURES_CASES)
+    @pytest.mark.parametrize("in_size", [(3, 64, 64), (3, 71, 50)])
+    def test_matches_feature_extractor(self, model_cls, kwargs, in_size):
+        kwargs = dict(dict(channels=[4, 5, 6, 7], pool_every=2), **kwargs)
+        model = model_cls(in_size=in_size, out_classes=4, hidden_dims=[6], **kwargs)
+        with torch.no_grad():
+            ext = model.eval().feature_extractor(torch.zeros(1, *in_size))
+        assert model._n_features() == ext.numel()
+
+
+class TestResNet(object):
+    def test_warns_on_kernel_sized_feature_map(self):
+        with pytest.warns(UserWarning, match="Block 1"):
+            ResNet(in_size=(3, 6, 6), out_classes=4, channels=[4, 4], pool_every=1, hidden_dims=[6],
+                   pooling_params=dict(kernel_size=2))
+
+    def test_rejects_channel_multiple(self):
+        with pytest.raises(AssertionError):
+            ResNet(in_size=(4, 8, 8), out_classes=4, channels=[4] * 4, pool_every=4, hidden_dims=[6],
+                   pooling_params=dict(kernel_size=2), bottleneck=True, channel_multiple=0)
+
+
+class TestReparam(object):
+    def test_merges_conv_conv(self):
+        torch.manual_seed(42)
+        model = make_cnn()
+        # No non-linearity between the convs, so they should be merged.
+        model.feature_extractor = nn.Sequential(
+            nn.Conv2d(3, 4, kernel_size=3, padding=1), nn.Identity(), nn.Conv2d(4, 5, kernel_size=1)
+        )
+        x = torch.randn(2, *IN_SIZE)
+        with torch.no_grad():
+            expected = model.eval()(x)
+            out = model.reparam_for_inference()(x)
+
+        convs = [m for m in model.feature_extractor if isinstance(m, nn.Conv2d)]
+        assert len(convs) == 1
+        assert convs[0].kernel_size == (3, 3)
+        assert torch.allclose(out, expected, atol=1e-5)
+
+    def test_keeps_padded_second_conv(self):
+        torch.manual_seed(42)
+        model = make_cnn()
+        model.feature_extractor = nn.Sequential(
+            nn.Conv2d(3, 4, kernel_size=3, padding=1), nn.Conv2d(4, 5, kernel_size=3, padding=1)
+        )
+        x = torch.randn(2, *IN_SIZE)
+        with torch.no_grad():
+            expected = model.eval()(x)
+            out = model.reparam_for_inference()(x)
+
+        assert len(model.feature_extractor) == 2
+        assert torch.allclose(out, expected, atol=1e-5)
+
+    @pytest.mark.skipif(not hasattr(torch, "compile"), reason="requires torch.compile")
+    @pytest.mark.parametrize("method", ["fuse", "reparam_for_inference", "optimize_for_inference"])
+    def test_rejects_compiled(self, method):
+        model = make_cnn(compile=True)
+        args = (torch.randn(2, *IN_SIZE),) if method == "optimize_for_inference" else ()
+        with pytest.raises(RuntimeError):
+            getattr(model, method)(*args)
+
+
+def warm_up_batchnorm(model, in_size):
+    # Move the BN running stats and affine params away from their defaults,
+    # so that folding them into the convs isn't trivial.
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            nn.init.uniform_(m.weight, 0.5, 1.5)
+            nn.init.uniform_(m.bias, -0.5, 0.5)
+    model.train()
+    with torch.no_grad():
+        for _ in range(5):
+            model(torch.randn(8, *in_size))
+
+
+class TestFuse(object):
+    @pytest.mark.parametrize("bn_order", ["post", "pre"])
+    def test_fused_block_output(self, bn_order):
+        torch.manual_seed(42)
+        block = ResidualBlock(
+            in_channels=3, channels=[6, 4] * 2, kernel_sizes=[3, 5] * 2,
+            batchnorm=True, dropout=0.2, bn_order=bn_order,
+        )
+        warm_up_batchnorm(block, (3, 16, 16))
+        x = torch.randn(2, 3, 16, 16)
+        with torch.no_grad():
+            expected = block.eval()(x)
+            block.fuse_for_inference()
+            out = block(x)
+
+        layers = list(block.main_path)
+        assert not any(isinstance(m, (nn.BatchNorm2d, nn.Dropout2d)) for m in layers)
+        assert torch.allclose(out, expected, atol=1e-5)
+
+    def test_fused_resnet_output(self):
+        torch.manual_seed(42)
+        model = ResNet(
+            in_size=(3, 16, 16), out_classes=5, channels=[8, 16, 16, 8, 16], pool_every=3,
+            hidden_dims=[10], pooling_params=dict(kernel_size=2), batchnorm=True, dropout=0.1,
+        )
+        warm_up_batchnorm(model, (3, 16, 16))
+        x = torch.randn(2, 3, 16, 16)
+        with torch.no_grad():
+            expected = model.eval()(x)
+            out = model.fuse()(x)
+
+        assert not any(isinstance(m, nn.BatchNorm2d) for m in model.modules())
+        assert torch.allclose(out, expected, atol=1e-5)
+
+    def test_bn_order_pre_layers(self):
+        block = ResidualBlock(
+            in_channels=3, channels=[6, 4], kernel_sizes=[3, 3],
+            batchnorm=True, dropout=0.2, bn_order="pre",
+        )
+        layer_types = [type(m) for m in block.main_path]
+        assert layer_types == [nn.Conv2d, nn.BatchNorm2d, nn.ReLU, nn.Dropout2d, nn.Conv2d]
+
+    @pytest.mark.parametrize("model_cls", [ResNet, YourCNN])
+    def test_bn_order_passed_to_blocks(self, model_cls):
+        model = model_cls(
+            in_size=(3, 16, 16), out_classes=5, channels=[8, 8], pool_every=2, hidden_dims=[10],
+            pooling_params=dict(kernel_size=2), batchnorm=True, dropout=0.1, bn_order="pre",
+        )
+        layers = list(model.feature_extractor[0].main_path)
+        assert model.bn_order == "pre"
+        assert isinstance(layers[1], nn.BatchNorm2d) and isinstance(layers[3], nn.Dropout2d)
+
+
+class TestMainPath(object):
+    @pytest.mark.parametrize("momentum", [0.1, None])
+    @pytest.mark.parametrize("activation_type", ["relu", "lrelu"])
+    def test_train_mode_matches_modules(self, momentum, activation_type):
+        torch.manual_seed(42)
+        block = ResidualBlock(
+            in_channels=3, channels=[6, 4], kernel_sizes=[3, 5], batchnorm=True, dropout=0.2,
+            activation_type=activation_type,
+        )
+        for m in block.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.momentum = momentum
+        reference = copy.deepcopy(block)
+        block.train()
+        reference.train()
+
+        for step in range(3):
+            x = torch.randn(2, 3, 8, 8, requires_grad=True)
+            x_ref = x.detach().clone().requires_grad_()
+            torch.manual_seed(step)
+            out, _ = block._main_path_forward(x)
+            torch.manual_seed(step)
+            expected = reference.main_path(x_ref)
+            assert torch.allclose(out, expected, atol=1e-6)
+
+            grad = torch.randn_like(out)
+            out.backward(grad)
+            expected.backward(grad)
+            assert torch.allclose(x.grad, x_ref.grad, atol=1e-6)
+
+        for p, p_ref in zip(block.main_path.parameters(), reference.main_path.parameters()):
+            assert torch.allclose(p.grad, p_ref.grad, atol=1e-5)
+        for b, b_ref in zip(block.main_path.buffers(), reference.main_path.buffers()):
+            assert torch.allclose(b.float(), b_ref.float(), atol=1e-6)
+
+    def test_calls_subclass_forward(self):
+        class ScaledConv(nn.Conv2d):
+            def forward(self, x):
+                return 2 * super().forward(x)
+
+        torch.manual_seed(42)
+        block = ResidualBlock(in_channels=3, channels=[6, 4], kernel_sizes=[3, 3])
+        conv = block.main_path[0]
+        scaled = ScaledConv(3, 6, kernel_size=3, padding=1)
+        scaled.load_state_dict(conv.state_dict())
+        block.main_path[0] = scaled
+        x = torch.randn(2, 3, 8, 8)
+        with torch.no_grad():
+            out, _ = block._main_path_forward(x)
+            expected = block.main_path(x)
+        assert torch.allclose(out, expected, atol=1e-6)
+
+
+class TestSkipAdd(object):
+    def test_identity_skip_backward(self):
+        torch.manual_seed(42)
+        block = ResidualBlock(in_channels=4, channels=[6, 4], kernel_sizes=[3, 3], batchnorm=True)
+        assert block.shortcut_path is None
+        x = torch.randn(2, 4, 8, 8, requires_grad=True)
+        x_ref = x.detach().clone().requires_grad_()
+        out = block(x)
+        expected = torch.relu(block.main_path(x_ref) + x_ref)
+        assert torch.allclose(out, expected, atol=1e-6)
+
+        grad = torch.randn_like(out)
+        out.backward(grad)
+        expected.backward(grad)
+        assert torch.allclose(x.grad, x_ref.grad, atol=1e-5)
+
+    @pytest.mark.parametrize("hooked", ["main_path", "last_layer"])
+    def test_hooked_output_not_modified(self, hooked):
+        torch.manual_seed(42)
+        block = ResidualBlock(in_channels=4, channels=[6, 4], kernel_sizes=[3, 3])
+        outputs = []
+        module = block.main_path if hooked == "main_path" else block.main_path[-1]
+        module.register_forward_hook(lambda m, inputs, output: outputs.append(output.clone()))
+        module.register_forward_hook(lambda m, inputs, output: outputs.append(output))
+        x = torch.randn(2, 4, 8, 8)
+        with torch.no_grad():
+            block(x)
+        assert torch.equal(outputs[0], outputs[1])
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+class TestCudaGraph(object):
+    def test_replay_matches_eager(self):
+        torch.manual_seed(42)
+        model = make_cnn(use_cuda_graph=True).cuda().eval()
+        x = torch.randn(4, *IN_SIZE, device="cuda")
+        with torch.no_grad():
+            expected = model(x)
+        model.capture_cuda_graph(torch.randn_like(x))
+        with torch.no_grad():
+            out = model(x)
+        assert model._cuda_graph is not None
+        assert torch.allclose(out, expected, atol=1e-5)
+
+
+class TestQuantize(object):
+    def test_quantized_close_to_fp32(self):
+        torch.manual_seed(42)
+        in_size = (3, 16, 16)
+        model = YourCNN(in_size=in_size, out_classes=5, channels=[8, 8, 16, 16], pool_every=2, hidden_dims=[10])
+        warm_up_batchnorm(model, in_size)
+        x = torch.rand(16, *in_size)
+        loader = [(x[i:i + 4], None) for i in range(0, len(x), 4)]
+        with torch.no_grad():
+            expected = model.eval()(x)
+            out = model.quantize_for_inference(loader)(x)
+
+        assert any(m._get_name().startswith("QuantizedConv") for m in model.feature_extractor.modules())
+        assert all(p.dtype == torch.float32 for p in model.mlp.parameters())
+        assert out.shape == expected.shape
+        assert torch.max(torch.abs(out - expected)) < 0.1 * torch.max(torch.abs(expected))
+
+    def test_rejects_quantized(self):
+        in_size = (3, 16, 16)
+        model = YourCNN(in_size=in_size, out_classes=5, channels=[8, 8], pool_every=2, hidden_dims=[10])
+        loader = [(torch.rand(4, *in_size), None)]
+        model.quantize_for_inference(loader)
+        with pytest.raises(RuntimeError):
+            model.quantize_for_inference(loader)
+
+    def test_rejects_amp(self):
+        in_size = (3, 16, 16)
+        model = YourCNN(in_size=in_size, out_classes=5, channels=[8, 8], pool_every=2, hidden_dims=[10],
+                        amp_dtype=torch.bfloat16)
+        with pytest.raises(RuntimeError):
+            model.quantize_for_inference([(torch.rand(4, *in_size), None)])
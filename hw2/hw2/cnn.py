@@ -1,15 +1,155 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import itertools as it
+import contextlib
+import warnings
 from torch import Tensor
-from typing import Sequence
-import math
+from typing import Optional, Sequence
+from torch.nn.modules.utils import _pair
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.nn.quantized import FloatFunctional
+from torch.ao.quantization import QuantStub, DeQuantStub, convert, fuse_modules, get_default_qconfig, prepare
 
 from .mlp import MLP, ACTIVATIONS, ACTIVATION_DEFAULT_KWARGS
 
 POOLINGS = {"avg": nn.AvgPool2d, "max": nn.MaxPool2d}
 
 
+@torch.jit.script
+def _add_relu(main: Tensor, skip: Tensor) -> Tensor:
+    # Scripted so that the fuser can merge the residual add and the relu into
+    # a single elementwise kernel.
+    return torch.relu(main + skip)
+
+
+def _out_size(size: int, kernel_size: int, stride: int, padding, dilation: int, ceil_mode: bool) -> int:
+    # As in the nn.Conv2d and nn.MaxPool2d docs.
+    if padding == "same":
+        return size
+    if padding == "valid":
+        padding = 0
+    numerator = size + 2 * padding - dilation * (kernel_size - 1) - 1
+    if not ceil_mode:
+        return numerator // stride + 1
+    out = -(-numerator // stride) + 1
+    # With ceil_mode, the last window must start inside the input or left padding.
+    if (out - 1) * stride >= size + padding:
+        out -= 1
+    return out
+
+
+def _out_hw(h: int, w: int, params: dict, pool: bool = False):
+    """
+    Calculates the spatial output size of a conv layer (or a pooling layer, if
+    pool) constructed with the given parameters.
+    :return: A tuple (h, w).
+    """
+    k = _pair(params['kernel_size'])
+    stride = params.get('stride', None if pool else 1)
+    s = k if stride is None else _pair(stride)
+    p = params.get('padding', 0)
+    p = (p, p) if isinstance(p, str) else _pair(p)
+    d = _pair(params.get('dilation', 1))
+    ceil_mode = params.get('ceil_mode', False)
+    return tuple(_out_size(n, k[i], s[i], p[i], d[i], ceil_mode) for i, n in enumerate((h, w)))
+
+
+def _batch_norm(bn: nn.BatchNorm2d, x: Tensor) -> Tensor:
+    # Same as nn.BatchNorm2d.forward, including the running stats update.
+    momentum = 0.0 if bn.momentum is None else bn.momentum
+    if bn.training and bn.track_running_stats:
+        bn.num_batches_tracked.add_(1)
+        if bn.momentum is None:
+            momentum = 1.0 / float(bn.num_batches_tracked)
+    use_batch_stats = bn.training or bn.running_mean is None
+    track = not bn.training or bn.track_running_stats
+    return F.batch_norm(
+        x, bn.running_mean if track else None, bn.running_var if track else None,
+        bn.weight, bn.bias, use_batch_stats, momentum, bn.eps,
+    )
+
+
+def _has_hooks(module: nn.Module) -> bool:
+    return bool(module._forward_hooks or module._forward_pre_hooks or module._backward_hooks)
+
+
+def _conv2d(conv: nn.Conv2d, x: Tensor, inplace: bool) -> Tensor:
+    if conv.padding_mode != "zeros":
+        return conv(x)
+    return F.conv2d(x, conv.weight, conv.bias, conv.stride, conv.padding, conv.dilation, conv.groups)
+
+
+# Functional versions of the main path layers, by exact layer type, so that
+# subclasses (which may override forward) are still called as modules.
+# inplace is False when the input may be observed elsewhere (e.g. by a hook).
+_FUNCTIONAL_LAYERS = {
+    nn.Conv2d: _conv2d,
+    nn.BatchNorm2d: lambda bn, x, inplace: _batch_norm(bn, x),
+    nn.Dropout2d: lambda d, x, inplace: F.dropout2d(x, d.p, d.training, d.inplace and inplace),
+    nn.ReLU: lambda r, x, inplace: F.relu(x, inplace=inplace),
+    nn.LeakyReLU: lambda r, x, inplace: F.leaky_relu(x, r.negative_slope, inplace=inplace),
+    nn.Identity: lambda i, x, inplace: x,
+}
+
+
+def _conv_padding(conv: nn.Conv2d):
+    if conv.padding == "valid":
+        return (0, 0)
+    if conv.padding == "same":
+        return tuple(k // 2 for k in conv.kernel_size)
+    return conv.padding
+
+
+def _can_merge_convs(conv1: nn.Conv2d, conv2: nn.Conv2d) -> bool:
+    # conv2(conv1(x)) is a single conv only if conv2 doesn't pad conv1's output,
+    # since conv1 isn't zero (e.g. its bias) outside of the input.
+    return (conv1.groups == conv2.groups == 1
+            and conv1.stride == conv2.stride == (1, 1)
+            and conv1.dilation == conv2.dilation == (1, 1)
+            and conv1.padding_mode == conv2.padding_mode == "zeros"
+            and _conv_padding(conv2) == (0, 0))
+
+
+@torch.no_grad()
+def _merge_convs(conv1: nn.Conv2d, conv2: nn.Conv2d) -> nn.Conv2d:
+    """
+    Merges two consecutive linear convolutions into a single conv, with a kernel
+    which is the full convolution of the two kernels.
+    """
+    k2_h, k2_w = conv2.kernel_size
+    weight = nn.functional.conv2d(
+        conv1.weight.transpose(0, 1), conv2.weight.flip(-2, -1), padding=(k2_h - 1, k2_w - 1)
+    ).transpose(0, 1)
+    bias = conv2.bias if conv2.bias is not None else torch.zeros_like(conv2.weight[:, 0, 0, 0])
+    if conv1.bias is not None:
+        bias = bias + conv2.weight.sum(dim=(2, 3)) @ conv1.bias
+
+    merged = nn.Conv2d(conv1.in_channels, conv2.out_channels, kernel_size=tuple(weight.shape[2:]),
+                       padding=_conv_padding(conv1))
+    merged = merged.to(device=weight.device, dtype=weight.dtype)
+    merged.weight.copy_(weight)
+    merged.bias.copy_(bias)
+    return merged
+
+
+def _merge_sequential_convs(seq: nn.Sequential) -> nn.Sequential:
+    """
+    Drops Identity layers from a Sequential and merges the convs which are then
+    adjacent, when possible.
+    """
+    layers = []
+    for layer in seq:
+        if isinstance(layer, nn.Identity):
+            continue
+        if isinstance(layer, nn.Conv2d) and layers and isinstance(layers[-1], nn.Conv2d) \
+                and _can_merge_convs(layers[-1], layer):
+            layers[-1] = _merge_convs(layers[-1], layer)
+        else:
+            layers.append(layer)
+    return nn.Sequential(*layers)
+
+
 class CNN(nn.Module):
     """
     A simple convolutional neural network model based on PyTorch nn.Modules.
@@ -17,6 +157,10 @@ class CNN(nn.Module):
     Has a convolutional part at the beginning and an MLP at the end.
     The architecture is:
     [(CONV -> ACT)*P -> POOL]*(N/P) -> (FC -> ACT)*M -> FC
+
+    zero_grad() defaults to set_to_none=True, which frees the gradients instead
+    of writing zeros over every parameter; prefer it (or
+    optimizer.zero_grad(set_to_none=True)) between training iterations.
     """
 
     def __init__(
@@ -31,6 +175,11 @@ class CNN(nn.Module):
         activation_params: dict = {},
         pooling_type: str = "max",
         pooling_params: dict = {},
+        cudnn_benchmark: bool = True,
+        channels_last: bool = True,
+        amp_dtype: Optional[torch.dtype] = None,
+        use_cuda_graph: bool = False,
+        compile: bool = False,
     ):
         """
         :param in_size: Size of input images, e.g. (C,H,W).
@@ -47,6 +196,28 @@ class CNN(nn.Module):
         :param pooling_type: Type of pooling to apply; supports 'max' for max-pooling or
             'avg' for average pooling.
         :param pooling_params: Parameters passed to pooling layer.
+        :param cudnn_benchmark: Whether to enable the cuDNN autotuner (only when
+            CUDA is available). The best conv algorithm is then selected per input
+            shape on the first forward pass on the GPU and cached, which pays off
+            for fixed-size batches. Set to False for deterministic runs.
+            Note that this is a global setting, so the last model created wins.
+        :param channels_last: Whether to keep the conv weights and feature maps in
+            channels_last (NHWC) memory format, which lets cuDNN use its tensor-core
+            kernels. These work best when the number of channels is divisible
+            by 8 (16 for fp16).
+        :param amp_dtype: If set (e.g. torch.bfloat16), the forward pass runs under
+            autocast with this dtype. bfloat16 doesn't need a GradScaler during
+            training. None means a plain fp32 forward.
+        :param use_cuda_graph: Whether capture_cuda_graph may be used to replay the
+            inference forward pass as a single CUDA graph.
+        :param compile: Whether to compile the feature extractor and the MLP with
+            torch.compile (requires torch>=2.0). Shapes are assumed to be static.
+            Note that the first forward passes are slow, as they compile the model.
+            The compiled modules wrap the original ones, so the keys of the
+            state_dict get an '_orig_mod.' prefix (e.g.
+            'feature_extractor._orig_mod.0.weight'). The inference passes
+            (fuse, reparam_for_inference, capture_cuda_graph, etc.) aren't
+            supported for compiled models.
         """
         super().__init__()
         assert channels and hidden_dims
@@ -61,6 +232,17 @@ class CNN(nn.Module):
         self.activation_params = activation_params
         self.pooling_type = pooling_type
         self.pooling_params = pooling_params
+        self.cudnn_benchmark = cudnn_benchmark
+        self.channels_last = channels_last
+        self.amp_dtype = amp_dtype
+        self.use_cuda_graph = use_cuda_graph
+        self.use_compile = compile
+        self._cuda_graph = None
+        self._static_in, self._static_out = None, None
+        self._quantized = False
+
+        if torch.cuda.is_available():
+            torch.backends.cudnn.benchmark = cudnn_benchmark
 
         if activation_type not in ACTIVATIONS or pooling_type not in POOLINGS:
             raise ValueError("Unsupported activation or pooling type")
@@ -68,6 +250,15 @@ class CNN(nn.Module):
         self.feature_extractor = self._make_feature_extractor()
         self.mlp = self._make_mlp()
 
+        if compile:
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("compile=True requires torch.compile (torch>=2.0)")
+            self.feature_extractor = torch.compile(self.feature_extractor, mode="max-autotune", dynamic=False)
+            self.mlp = torch.compile(self.mlp, mode="max-autotune", dynamic=False)
+
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
     def _make_feature_extractor(self):
         in_channels, in_h, in_w, = tuple(self.in_size)
 
@@ -84,18 +275,14 @@ class CNN(nn.Module):
         self.conv_out_w = in_w
         self.conv_out_h = in_h
         pool_func = POOLINGS[self.pooling_type]
-        phi = ACTIVATIONS[self.activation_type](**self.activation_params)
-        pool_count = 0
-        for cin,cout in zip([in_channels] + self.channels[:-1],self.channels[:]):
-            layers += [nn.Conv2d(cin,cout,**self.conv_params)]
-            layers += [phi]
-            self.conv_out_w = math.floor((self.conv_out_w - self.conv_params['kernel_size'] + 2 * self.conv_params['padding']) / self.conv_params['stride'])
-            self.conv_out_h = math.floor((self.conv_out_h - self.conv_params['kernel_size'] + 2 * self.conv_params['padding']) / self.conv_params['stride'])
-            pool_count += 1
-            if pool_count % self.pool_every == 0:
-                layers += [pool_func(**self.pooling_params)]
-                self.conv_out_w = math.floor(self.conv_out_w / self.pooling_params['kernel_size'])
-                self.conv_out_h = math.floor(self.conv_out_h / self.pooling_params['kernel_size'])
+        for i, (cin, cout) in enumerate(zip([in_channels, *self.channels[:-1]], self.channels), start=1):
+            layers.append(nn.Conv2d(cin,cout,**self.conv_params))
+            layers.append(self._make_phi())
+            self.conv_out_h, self.conv_out_w = _out_hw(self.conv_out_h, self.conv_out_w, self.conv_params)
+            if i % self.pool_every == 0:
+                layers.append(pool_func(**self.pooling_params))
+                self.conv_out_h, self.conv_out_w = _out_hw(self.conv_out_h, self.conv_out_w,
+                                                           self.pooling_params, pool=True)
 
         # raise NotImplementedError()
 
@@ -103,21 +290,40 @@ class CNN(nn.Module):
         seq = nn.Sequential(*layers)
         return seq
 
+    def _make_phi(self) -> nn.Module:
+        """
+        Creates a new activation module. Each layer gets its own instance, so
+        that activations with parameters (e.g. PReLU) aren't shared between
+        layers and no module appears twice in a Sequential.
+        """
+        return ACTIVATIONS[self.activation_type](**self.activation_params)
+
     def _n_features(self) -> int:
         """
         Calculates the number of extracted features going into the the classifier part.
+        The output spatial size is tracked while building the feature extractor,
+        so this is computed analytically instead of with a dummy forward pass.
         :return: Number of features.
         """
-        # Make sure to not mess up the random state.
-        rng_state = torch.get_rng_state()
+        # ====== YOUR CODE: ======
+        if hasattr(self, 'conv_out_w'):
+            return self.channels[-1] * self.conv_out_w * self.conv_out_h
+
+        # Fallback for feature extractors which don't track their output size.
+        # In eval mode nothing samples random numbers (e.g. Dropout) or updates
+        # running stats (BatchNorm), so the random state is left untouched.
+        was_training = self.feature_extractor.training
+        param = next(self.feature_extractor.parameters(), None)
+        device = param.device if param is not None else None
+        self.feature_extractor.eval()
         try:
-            # ====== YOUR CODE: ======
-            ext = self.feature_extractor(torch.unsqueeze(torch.zeros(self.in_size),0))
-            return torch.numel(ext)
-            # raise NotImplementedError()
-            # ========================
+            with torch.no_grad():
+                ext = self.feature_extractor(torch.zeros(1, *self.in_size, device=device))
+            return ext.numel()
         finally:
-            torch.set_rng_state(rng_state)
+            self.feature_extractor.train(was_training)
+        # raise NotImplementedError()
+        # ========================
 
     def _make_mlp(self):
         # TODO:
@@ -128,11 +334,10 @@ class CNN(nn.Module):
         #  - The last Linear layer should have an output dim of out_classes.
         mlp: MLP = None
         # ====== YOUR CODE: ======
-        phi = ACTIVATIONS[self.activation_type](**self.activation_params)
         mlp = MLP(
                 in_dim = self._n_features(),
                 dims = self.hidden_dims+[self.out_classes],
-                nonlins = [*[phi]*(len(self.hidden_dims)), 'none']
+                nonlins = [*[self._make_phi() for _ in self.hidden_dims], 'none']
                 )
 
         # raise NotImplementedError()
@@ -140,18 +345,143 @@ class CNN(nn.Module):
         return mlp
 
     def forward(self, x: Tensor):
+        """
+        :param x: Input batch of shape (N,C,H,W).
+        :return: Class scores of shape (N,out_classes). The extracted features
+            are flattened with torch.flatten, which returns a view when possible;
+            a channels_last feature map is gathered once into the row-major
+            (C,H,W) order expected by the MLP.
+        """
+        if self._cuda_graph is not None and not self.training and not torch.is_grad_enabled() \
+                and x.shape == self._static_in.shape and x.dtype == self._static_in.dtype \
+                and x.device == self._static_in.device:
+            self._static_in.copy_(x)
+            self._cuda_graph.replay()
+            return self._static_out.clone()
+
         # TODO: Implement the forward pass.
         #  Extract features from the input, run the classifier on them and
         #  return class scores.
         out: Tensor = None
         # ====== YOUR CODE: ======
-        out = self.feature_extractor(x)
-        out = out.reshape(out.shape[0],-1)
-        out = self.mlp(out)
+        # Lay out the input once here, instead of in each conv.
+        x = x.contiguous(memory_format=torch.channels_last if self.channels_last else torch.contiguous_format)
+        if self.amp_dtype is not None:
+            amp = torch.autocast(device_type=x.device.type, dtype=self.amp_dtype)
+        else:
+            amp = contextlib.nullcontext()
+        with amp:
+            out = self.feature_extractor(x)
+            out = torch.flatten(out, start_dim=1)
+            out = self.mlp(out)
+        if self.amp_dtype is not None:
+            out = out.float()
         # raise NotImplementedError()
         # ========================
         return out
 
+    def _reset_cuda_graph(self):
+        # A captured graph refers to the memory of the current parameters.
+        self._cuda_graph = None
+        self._static_in, self._static_out = None, None
+
+    def _apply(self, fn, *args, **kwargs):
+        # Used by .to(), .cuda(), .half() etc., which may move parameter storage.
+        self._reset_cuda_graph()
+        return super()._apply(fn, *args, **kwargs)
+
+    def zero_grad(self, set_to_none: bool = True):
+        super().zero_grad(set_to_none=set_to_none)
+
+    def fuse(self):
+        """
+        Prepares the model for inference by fusing the Conv+BN pairs of all its
+        residual blocks (see ResidualBlock.fuse_for_inference).
+        Puts the model in eval mode; don't train the model after calling this.
+        Not supported for compiled models.
+        :return: The model itself.
+        """
+        if self.use_compile:
+            raise RuntimeError("Can't fuse a compiled model")
+        self._reset_cuda_graph()
+        self.eval()
+        for module in self.modules():
+            if isinstance(module, ResidualBlock):
+                module.fuse_for_inference()
+        return self
+
+    def reparam_for_inference(self):
+        """
+        Fuses the model (see fuse), then merges every pair of convolutions with
+        no non-linearity between them into a single conv, in the feature
+        extractor and in the main path of each residual block. Convs can't be
+        merged if they are strided, dilated or grouped, or if the second one
+        pads its input; in that case they are left as is.
+        Not supported for compiled or quantized models.
+        :return: The model itself.
+        """
+        if self.use_compile or self._quantized:
+            raise RuntimeError("Can't reparametrize a compiled or quantized model")
+        self.fuse()
+        self._reset_cuda_graph()
+        self.feature_extractor = _merge_sequential_convs(self.feature_extractor)
+        for module in self.feature_extractor.modules():
+            if isinstance(module, ResidualBlock):
+                module.main_path = _merge_sequential_convs(module.main_path)
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
+        return self
+
+    def capture_cuda_graph(self, example_input: Tensor, warmup_iters: int = 3):
+        """
+        Captures the inference forward pass for inputs with the shape of
+        example_input into a CUDA graph. Afterwards, forward calls in eval mode
+        with an input of that shape, dtype and device replay the graph instead of
+        launching each kernel separately. Other inputs, training mode and forward
+        calls with grad enabled use the regular forward pass.
+        The graph is dropped by anything which replaces the model's modules or
+        parameter storage (fuse, reparam_for_inference, .to(), etc.).
+        :param example_input: A batch of inputs on the model's (CUDA) device.
+        :param warmup_iters: Number of forward passes to run before capturing.
+        """
+        if not self.use_cuda_graph:
+            raise RuntimeError("CUDA graphs are disabled, create the model with use_cuda_graph=True")
+        if self.use_compile:
+            raise RuntimeError("Can't capture a CUDA graph of a compiled model")
+        self.eval()
+        self._reset_cuda_graph()
+        static_in = example_input.clone()
+
+        # Warm up on a side stream (e.g. for the cuDNN autotuner), as required for capture.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.no_grad():
+            for _ in range(warmup_iters):
+                self(static_in)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph), torch.no_grad():
+            static_out = self(static_in)
+
+        self._cuda_graph = graph
+        self._static_in, self._static_out = static_in, static_out
+
+    def optimize_for_inference(self, example_input: Tensor):
+        """
+        Fuses the model (see fuse), then traces, freezes and optimizes it with
+        TorchScript for inference.
+        :param example_input: A batch of inputs with the shape used at inference.
+        :return: The optimized ScriptModule. The model itself is left fused and
+            in eval mode.
+        """
+        if self.use_compile:
+            raise RuntimeError("Can't optimize a compiled model with TorchScript")
+        self.fuse()
+        with torch.no_grad():
+            traced = torch.jit.trace(self, example_input)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
 
 class ResidualBlock(nn.Module):
     """
@@ -167,6 +497,7 @@ class ResidualBlock(nn.Module):
         dropout: float = 0.0,
         activation_type: str = "relu",
         activation_params: dict = {},
+        bn_order: str = "post",
         **kwargs,
     ):
         """
@@ -183,6 +514,9 @@ class ResidualBlock(nn.Module):
         :param activation_type: Type of activation function; supports either 'relu' or
             'lrelu' for leaky relu.
         :param activation_params: Parameters passed to activation function.
+        :param bn_order: Order of the layers between convolutions; either 'post' for
+            CONV -> DROPOUT -> BN -> ACT, or 'pre' for CONV -> BN -> ACT -> DROPOUT
+            (the canonical ResNet order, with BN directly after its conv).
         """
         super().__init__()
         assert channels and kernel_sizes
@@ -191,8 +525,12 @@ class ResidualBlock(nn.Module):
 
         if activation_type not in ACTIVATIONS:
             raise ValueError("Unsupported activation type")
+        if bn_order not in ("post", "pre"):
+            raise ValueError("Unsupported bn_order")
 
         self.main_path, self.shortcut_path = None, None
+        # Set by prepare_quantization, for the residual add on quantized tensors.
+        self.skip_add = None
 
         # TODO: Implement a generic residual block.
         #  Use the given arguments to create two nn.Sequentials:
@@ -210,25 +548,35 @@ class ResidualBlock(nn.Module):
         # ====== YOUR CODE: ======
         all_channels = [in_channels] + channels[:]
         main_layers = []
-        phi = ACTIVATIONS[activation_type](**activation_params)
+        def make_phi():
+            return ACTIVATIONS[activation_type](**activation_params)
         for i in range(len(kernel_sizes)):
             cin, cout = all_channels[i], all_channels[i+1]
-            main_layers +=[nn.Conv2d(cin,cout,kernel_size=kernel_sizes[i],bias=True,padding='same')]
+            # Kernel sizes are odd, so this padding preserves the spatial extent.
+            pad = kernel_sizes[i] // 2
+            main_layers +=[nn.Conv2d(cin,cout,kernel_size=kernel_sizes[i],bias=True,padding=pad)]
             if i == len(kernel_sizes) - 1:
                 break
+            if bn_order == "pre":
+                if batchnorm is True:
+                    main_layers += [nn.BatchNorm2d(all_channels[i + 1])]
+                main_layers += [make_phi()]
+                if dropout > 0:
+                    main_layers += [nn.Dropout2d(dropout)]
+                continue
             if dropout > 0:
                 main_layers += [nn.Dropout2d(dropout)]
             if batchnorm is True:
                     main_layers += [nn.BatchNorm2d(all_channels[i + 1])]
             
-            main_layers += [phi]
+            main_layers += [make_phi()]
         
         self.main_path = nn.Sequential(*main_layers)
         
-        # Short Layers.
-        short_layers = [nn.Identity()] if in_channels == channels[-1] else [nn.Conv2d(in_channels,channels[-1],kernel_size=1,bias=False,padding='same')]
-        
-        self.shortcut_path = nn.Sequential(*short_layers)
+        # Short Layers. An identity skip is kept as None, so that forward doesn't
+        # need to call a module for it.
+        if in_channels != channels[-1]:
+            self.shortcut_path = nn.Sequential(nn.Conv2d(in_channels,channels[-1],kernel_size=1,bias=False,padding=0))
         # raise NotImplementedError()
         # ========================
 
@@ -236,12 +584,94 @@ class ResidualBlock(nn.Module):
         # TODO: Implement the forward pass. Save the main and residual path to `out`.
         out: Tensor = None
         # ====== YOUR CODE: ======
-        out = self.main_path(x) + self.shortcut_path(x)
+        if self.skip_add is not None:
+            skip = x if self.shortcut_path is None else self.shortcut_path(x)
+            return self.skip_add.add_relu(self.main_path(x), skip)
+
+        out, owned = self._main_path_forward(x)
+        if self.shortcut_path is None and owned:
+            # The main path ends with a conv, which doesn't need its output for
+            # backward, so it's safe to add the skip and relu in-place (unless
+            # a hook may hold on to the output).
+            out = torch.relu_(out.add_(x))
+        elif self.shortcut_path is None:
+            out = _add_relu(out, x)
+        else:
+            out = _add_relu(out, self.shortcut_path(x))
         # raise NotImplementedError()
         # ========================
-        out = torch.relu(out)
         return out
 
+    def _main_path_forward(self, x: Tensor):
+        """
+        Runs the main path by calling the functional ops directly with each
+        layer's parameters and buffers, which skips the nn.Module call overhead
+        of each layer. Layers with hooks (e.g. weight_norm, spectral_norm and
+        prune recompute the weight in a forward pre-hook), layers of other types
+        (including subclasses) and convs with a non-zero padding_mode are called
+        as modules. The activations run in-place, except on the output of such
+        a hooked layer. Note that the type dispatch here isn't scriptable.
+        :return: A tuple of the output, and whether it's owned by this call,
+            i.e. it's safe to modify in-place.
+        """
+        if _has_hooks(self.main_path):
+            return self.main_path(x), False
+        # The block input always goes through a conv first, so it's never
+        # modified in-place.
+        owned = True
+        for layer in self.main_path:
+            fn = _FUNCTIONAL_LAYERS.get(type(layer))
+            if fn is None or _has_hooks(layer):
+                x, owned = layer(x), False
+            else:
+                y = fn(layer, x, owned)
+                owned, x = owned or y is not x, y
+        return x, owned
+
+    def prepare_quantization(self):
+        """
+        Prepares a fused block (see fuse_for_inference) for eager-mode
+        quantization: fuses each Conv+ReLU pair and makes forward call the
+        layers as modules, with the residual add+relu done by a FloatFunctional
+        so that it can be observed and quantized.
+        """
+        conv_idx, pairs = None, []
+        for i, layer in enumerate(self.main_path):
+            if isinstance(layer, nn.Conv2d):
+                conv_idx = i
+            elif isinstance(layer, nn.Identity):
+                continue
+            else:
+                if isinstance(layer, nn.ReLU) and conv_idx is not None:
+                    pairs.append([str(conv_idx), str(i)])
+                conv_idx = None
+        if pairs:
+            fuse_modules(self.main_path, pairs, inplace=True)
+        self.skip_add = FloatFunctional()
+
+    def fuse_for_inference(self):
+        """
+        Folds each BatchNorm of the main path into the convolution before it and
+        replaces it (and any Dropout) with an Identity, so each inner layer is
+        a single conv. Works with both bn_order's, since Dropout is a no-op in
+        eval mode. Only valid for inference, the block must be in eval mode.
+        """
+        assert not self.training, "Conv+BN fusion is only valid in eval mode"
+        conv_idx = None
+        for i, layer in list(enumerate(self.main_path)):
+            if isinstance(layer, nn.Conv2d):
+                conv_idx = i
+            elif isinstance(layer, nn.Dropout2d):
+                self.main_path[i] = nn.Identity()
+            elif isinstance(layer, nn.Identity):
+                continue
+            elif isinstance(layer, nn.BatchNorm2d) and conv_idx is not None and layer.running_mean is not None:
+                self.main_path[conv_idx] = fuse_conv_bn_eval(self.main_path[conv_idx], layer)
+                self.main_path[i] = nn.Identity()
+                conv_idx = None
+            else:
+                conv_idx = None
+
 
 class ResidualBottleneckBlock(ResidualBlock):
     """
@@ -253,6 +683,7 @@ class ResidualBottleneckBlock(ResidualBlock):
         in_out_channels: int,
         inner_channels: Sequence[int],
         inner_kernel_sizes: Sequence[int],
+        channel_multiple: int = 1,
         **kwargs,
     ):
         """
@@ -268,15 +699,21 @@ class ResidualBottleneckBlock(ResidualBlock):
         :param inner_kernel_sizes: List of kernel sizes (spatial) for the internal
             convolutions in the block. Length should be the same as inner_channels.
             Values should be odd numbers.
+        :param channel_multiple: Round the inner number of channels up to a multiple
+            of this, e.g. 16 so that the 1x1 projections map onto tensor-core
+            GEMM tiles. The block output keeps in_out_channels, since the last
+            projection maps back to it anyway.
         :param kwargs: Any additional arguments supported by ResidualBlock.
         """
         assert len(inner_channels) > 0
         assert len(inner_channels) == len(inner_kernel_sizes)
+        assert channel_multiple >= 1
 
         # TODO:
         #  Initialize the base class in the right way to produce the bottleneck block
         #  architecture.
         # ====== YOUR CODE: ======
+        inner_channels = [-(-c // channel_multiple) * channel_multiple for c in inner_channels]
         _inner_channels = [inner_channels[0]] + inner_channels + [in_out_channels]
         _inner_kernel_sizes = [1] + inner_kernel_sizes + [1]
                    
@@ -299,16 +736,22 @@ class ResNet(CNN):
         batchnorm=False,
         dropout=0.0,
         bottleneck: bool = False,
+        channel_multiple: int = 1,
+        bn_order: str = "post",
         **kwargs,
     ):
         """
         See arguments of CNN & ResidualBlock.
         :param bottleneck: Whether to use a ResidualBottleneckBlock to group together
             pool_every convolutions, instead of a ResidualBlock.
+        :param channel_multiple: See ResidualBottleneckBlock.
+        :param bn_order: See ResidualBlock.
         """
         self.batchnorm = batchnorm
         self.dropout = dropout
+        self.bn_order = bn_order
         self.bottleneck = bottleneck
+        self.channel_multiple = channel_multiple
         super().__init__(
             in_size, out_classes, channels, pool_every, hidden_dims, **kwargs
         )
@@ -333,48 +776,43 @@ class ResNet(CNN):
         all_channels = [in_channels] + self.channels 
         pool_func = POOLINGS[self.pooling_type]
         pools_num = len(self.channels) // self.pool_every
-        for i in range(pools_num):
-            if all_channels[i * self.pool_every] != all_channels[self.pool_every*(i + 1)] or not self.bottleneck:
-                layers += [ResidualBlock(all_channels[i * self.pool_every], 
-                                         all_channels[i * self.pool_every + 1 : (i + 1) * self.pool_every + 1], 
-                                         kernel_sizes = [3] * self.pool_every,
-                                         batchnorm = self.batchnorm,
-                                         dropout = self.dropout,
-                                         activation_type = self.activation_type,
-                                         activation_params = self.activation_params)]
-            else:
-                layers += [ResidualBottleneckBlock(
-                                         in_out_channels = int(all_channels[i * self.pool_every]), 
-                                         inner_channels = all_channels[i * self.pool_every + 2 : (i + 1) * self.pool_every], 
-                                         inner_kernel_sizes = [3] * (self.pool_every - 2),
-                                         batchnorm = self.batchnorm,
-                                         dropout = self.dropout,
-                                         activation_type = self.activation_type,
-                                         activation_params = self.activation_params)]
-                    
-            layers += [pool_func(**self.pooling_params)]
+        block_params = dict(batchnorm = self.batchnorm,
+                            dropout = self.dropout,
+                            activation_type = self.activation_type,
+                            activation_params = self.activation_params,
+                            bn_order = self.bn_order)
+        # Each group holds the input channels of a block followed by the output
+        # channels of its convolutions. A pool follows each of the full groups.
+        groups = [all_channels[i * self.pool_every : (i + 1) * self.pool_every + 1] for i in range(pools_num)]
         length = len(self.channels) % self.pool_every
         if length > 0: # channels remaining..
-            if all_channels[-length - 1] != all_channels[-1] or not self.bottleneck:
-                layers += [ResidualBlock(all_channels[-length - 1], 
-                                     all_channels[-length:], 
-                                     kernel_sizes = [3] * length,
-                                     batchnorm = self.batchnorm,
-                                     dropout = self.dropout,
-                                     activation_type = self.activation_type,
-                                     activation_params = self.activation_params)]
-            else: 
-                layers += [ResidualBottleneckBlock(
-                                     in_out_channels = int(all_channels[-length - 1]), 
-                                     inner_channels = all_channels[-length:-1], 
-                                     inner_kernel_sizes = [3] * (self.pool_every - 2),
-                                     batchnorm = self.batchnorm,
-                                     dropout = self.dropout,
-                                     activation_type = self.activation_type,
-                                     activation_params = self.activation_params)]
+            groups.append(all_channels[-length - 1:])
+        # The block convs preserve the spatial extent, only the pools change it.
+        self.conv_out_h, self.conv_out_w = in_h, in_w
+        kernel_size = 3
+        for i, group in enumerate(groups):
+            # A bottleneck needs at least one inner conv between its projections.
+            if group[0] != group[-1] or not self.bottleneck or len(group) < 4:
+                layers.append(ResidualBlock(group[0], group[1:],
+                                            kernel_sizes = [kernel_size] * (len(group) - 1),
+                                            **block_params))
+            else:
+                layers.append(ResidualBottleneckBlock(
+                                         in_out_channels = int(group[0]),
+                                         inner_channels = group[2:-1],
+                                         inner_kernel_sizes = [kernel_size] * (len(group) - 3),
+                                         channel_multiple = self.channel_multiple,
+                                         **block_params))
+            # cuDNN can pick pathologically slow algorithms when the feature
+            # map is the size of the kernel.
+            if min(self.conv_out_h, self.conv_out_w) == kernel_size:
+                warnings.warn(f"Block {i} gets a feature map the size of its "
+                              f"{kernel_size}x{kernel_size} kernels")
+            if i < pools_num:
+                layers.append(pool_func(**self.pooling_params))
+                self.conv_out_h, self.conv_out_w = _out_hw(self.conv_out_h, self.conv_out_w,
+                                                           self.pooling_params, pool=True)
                     
-        self.conv_out_w = in_w // (self.pooling_params['kernel_size']**pools_num)
-        self.conv_out_h = in_h // (self.pooling_params['kernel_size']**pools_num)
                     
         # raise NotImplementedError()
         # ========================
@@ -383,12 +821,14 @@ class ResNet(CNN):
 
 
 class YourCNN(CNN):
-    def __init__(self, in_size, out_classes: int, channels: Sequence[int], pool_every: int, hidden_dims: Sequence[int], batchnorm = True, activation_type: str = "lrelu", activation_params: dict = dict(negative_slope = 0.01), pooling_type: str = "max", pooling_params: dict = dict(kernel_size = 2), dropout = 0.1, **kwargs):
+    def __init__(self, in_size, out_classes: int, channels: Sequence[int], pool_every: int, hidden_dims: Sequence[int], batchnorm = True, activation_type: str = "lrelu", activation_params: dict = dict(negative_slope = 0.01), pooling_type: str = "max", pooling_params: dict = dict(kernel_size = 2), dropout = 0.1, bn_order: str = "post", **kwargs):
         """
         See CNN.__init__
+        :param bn_order: See ResidualBlock.
         """
         self.dropout = dropout
         self.batchnorm = batchnorm
+        self.bn_order = bn_order
 
 
         super().__init__(in_size, out_classes, channels, pool_every, hidden_dims,
@@ -415,29 +855,64 @@ class YourCNN(CNN):
         pools_num = len(self.channels) // self.pool_every
         
         layers = []
-        for i in range(pools_num):
-            layers += [ResidualBlock(all_channels[i * self.pool_every], 
-                                         all_channels[i * self.pool_every + 1 : (i + 1) * self.pool_every + 1], 
-                                         kernel_sizes = [3] * self.pool_every,
-                                         batchnorm = self.batchnorm,
-                                         dropout = self.dropout,
-                                         activation_type = self.activation_type,
-                                         activation_params = self.activation_params)]
-            
-            layers += [pool_func(**self.pooling_params)]
+        groups = [all_channels[i * self.pool_every : (i + 1) * self.pool_every + 1] for i in range(pools_num)]
         length = len(self.channels) % self.pool_every
         if length > 0: 
-            layers += [ResidualBlock(all_channels[-length - 1], 
-                                     all_channels[-length:], 
-                                     kernel_sizes = [3] * length,
-                                     batchnorm = self.batchnorm,
-                                     dropout = self.dropout,
-                                     activation_type = self.activation_type,
-                                     activation_params = self.activation_params)]
+            groups.append(all_channels[-length - 1:])
+        self.conv_out_h, self.conv_out_w = in_h, in_w
+        for i, group in enumerate(groups):
+            layers.append(ResidualBlock(group[0], group[1:],
+                                        kernel_sizes = [3] * (len(group) - 1),
+                                        batchnorm = self.batchnorm,
+                                        dropout = self.dropout,
+                                        activation_type = self.activation_type,
+                                        activation_params = self.activation_params,
+                                        bn_order = self.bn_order))
+            if i < pools_num:
+                layers.append(pool_func(**self.pooling_params))
+                self.conv_out_h, self.conv_out_w = _out_hw(self.conv_out_h, self.conv_out_w,
+                                                           self.pooling_params, pool=True)
                     
-        self.conv_out_w = in_w // (self.pooling_params['kernel_size']**pools_num)
-        self.conv_out_h = in_h // (self.pooling_params['kernel_size']**pools_num)
         seq = nn.Sequential(*layers)
         return seq
+
+    def quantize_for_inference(self, calibration_loader, num_batches: int = 10, backend: str = "fbgemm"):
+        """
+        Quantizes the feature extractor to int8 with post-training static
+        quantization. The model is fused (see fuse), moved to the CPU and
+        calibrated on a few batches; the MLP stays in fp32.
+        This is an inference-only path: the quantized model can't be trained,
+        and the int8 kernels of the eager-mode quantization run on the CPU only.
+        :param calibration_loader: DataLoader of (x, y) batches used to
+            calibrate the ranges of the activations.
+        :param num_batches: Number of batches to calibrate on.
+        :param backend: Quantized engine, 'fbgemm' for x86 or 'qnnpack' for ARM.
+            Note that this sets torch.backends.quantized.engine, which is global
+            to the process and so affects all other quantized models as well.
+        :return: The model itself.
+        """
+        if self._quantized:
+            raise RuntimeError("The model is already quantized")
+        if self.amp_dtype is not None or self.use_compile:
+            raise RuntimeError("Can't quantize a model with amp_dtype or compile enabled")
+        self.cpu()
+        self.fuse()
+        self._reset_cuda_graph()
+        for module in self.feature_extractor.modules():
+            if isinstance(module, ResidualBlock):
+                module.prepare_quantization()
+
+        torch.backends.quantized.engine = backend
+        self.feature_extractor = nn.Sequential(QuantStub(), self.feature_extractor, DeQuantStub())
+        self.feature_extractor.qconfig = get_default_qconfig(backend)
+        prepare(self.feature_extractor, inplace=True)
+        with torch.no_grad():
+            for i, (x, *_) in enumerate(calibration_loader):
+                if i >= num_batches:
+                    break
+                self(x)
+        convert(self.feature_extractor, inplace=True)
+        self._quantized = True
+        return self
     # raise NotImplementedError()
     # ========================